@@ -1,6 +1,6 @@
 import asyncio
 from datetime import datetime, timezone
-import json
+import itertools
 import logging
 import os
 import traceback
@@ -10,16 +10,18 @@ from requests.packages.urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
 
 import aiohttp
-import xml.etree.ElementTree as ET
-import jsonlines
+from lxml import etree
 
 import s3util
-from helper import calc_time, to_isoformat, is_ok_url, filter_data
+from helper import calc_time, to_isoformat, is_ok_url, filter_data, drain
 
-# requests retry backoff config
+# requests retry backoff config (also used for sitemap fetch by aiohttp)
+RETRY_TOTAL = 5
+RETRY_BACKOFF_FACTOR = 1
+RETRY_STATUS_FORCELIST = [500, 502, 503, 504]
 s = requests.Session()
-retries = Retry(total=5, backoff_factor=1,
-                status_forcelist=[500, 502, 503, 504])
+retries = Retry(total=RETRY_TOTAL, backoff_factor=RETRY_BACKOFF_FACTOR,
+                status_forcelist=RETRY_STATUS_FORCELIST)
 s.mount("https://", HTTPAdapter(max_retries=retries))
 s.mount("http://", HTTPAdapter(max_retries=retries))
 
@@ -36,38 +38,54 @@ PREFIX_BASE = os.environ.get("PREFIX")
 PREFIX = PREFIX_BASE + "/" + TIMESTAMP
 SEMAPHORE = int(os.environ.get("SEMAPHORE", 30))
 
+# Drop comments so that every child of sitemap root is <sitemap>/<url>,
+# and never resolve entities or fetch over network from remote sitemap
+xml_parser = etree.XMLParser(
+    remove_comments=True, remove_pis=True, resolve_entities=False, no_network=True)
+
 
 async def fetch(url, session):
     """
     Get HTML
     """
-    await asyncio.sleep(2)
     doc_json = {}
 
-    try:
-        logger.debug("  GET -> {}".format(url))
-
-        # Get ja docs if existing
-        url_ja = url.replace(".com/", ".com/ja_jp/")
+    # Get ja docs if existing
+    url_ja = url.replace(".com/", ".com/ja_jp/")
+    crawled_at = datetime.now(timezone.utc).replace(microsecond=0).isoformat()
 
-        response = await session.get(url)
-        response_ja = await session.get(url_ja)
+    try:
+        logger.debug("  GET -> %s", url)
+
+        # Read each body before the next request so that one semaphore slot
+        # holds at most one pooled connection
+        async with session.get(url) as response:
+            status = response.status
+            headers = response.headers
+            html = await response.text("utf-8") if status == 200 else None
+        if status != 200:
+            return doc_json
+
+        async with session.get(url_ja) as response_ja:
+            status_ja = response_ja.status
+            headers_ja = response_ja.headers
+            html_ja = await response_ja.text("utf-8") if status_ja == 200 else None
         crawled_at = datetime.now(timezone.utc).replace(
             microsecond=0).isoformat()
 
-        if response.status == 200 and response_ja.status == 200:
+        if status_ja == 200:
             doc_json = {
                 "crawled_at": crawled_at,
                 "url": url,
-                "status": response.status,
-                "last_modified": to_isoformat(response.headers["Last-Modified"]),
-                "etag": response.headers["Etag"],
-                "html": await response.text("utf-8"),
+                "status": status,
+                "last_modified": to_isoformat(headers["Last-Modified"]),
+                "etag": headers["Etag"],
+                "html": html,
                 "url_ja": url_ja,
-                "status_ja": response_ja.status,
-                "last_modified_ja": to_isoformat(response_ja.headers["Last-Modified"]),
-                "etag_ja": response_ja.headers["Etag"],
-                "html_ja": await response_ja.text("utf-8"),
+                "status_ja": status_ja,
+                "last_modified_ja": to_isoformat(headers_ja["Last-Modified"]),
+                "etag_ja": headers_ja["Etag"],
+                "html_ja": html_ja,
                 "message": None,
             }
     except Exception:
@@ -102,18 +120,87 @@ async def burst_fetch(url, session, sem):
         return await fetch(url, session)
 
 
-async def get_doc_by_service(urls):
+async def fetch_sitemap(service_sitemap_url, session, sem):
+    """
+    Get sitemap.xml with retry backoff
+
+    Retry on 5xx and connection errors like the requests session does.
+    Return None if sitemap cannot be retrieved
+    """
+    for attempt in range(RETRY_TOTAL + 1):
+        if attempt > 0:
+            await asyncio.sleep(RETRY_BACKOFF_FACTOR * (2 ** (attempt - 1)))
+
+        try:
+            async with sem:
+                # Some sitemap redirects directory to one document url so stop redirect
+                async with session.get(service_sitemap_url, allow_redirects=False) as response:
+                    if response.status in RETRY_STATUS_FORCELIST:
+                        logger.warning(
+                            "retrying {} due to {}({})".format(
+                                service_sitemap_url, response.status, response.reason
+                            )
+                        )
+                        continue
+                    if response.status != 200:
+                        logger.warning(
+                            "failed to get {} due to {}({})".format(
+                                service_sitemap_url, response.status, response.reason
+                            )
+                        )
+                        return None
+                    return await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning("retrying {} due to {!r}".format(
+                service_sitemap_url, e))
+
+    logger.error("Error while GET {}: retries exhausted".format(
+        service_sitemap_url))
+    return None
+
+
+async def get_service_urls(service_sitemap_url, session, sem):
+    """
+    Get document URLs listed in service sitemap.xml
+    """
+    try:
+        body = await fetch_sitemap(service_sitemap_url, session, sem)
+        if body is None:
+            return []
+
+        service_root = etree.fromstring(body, xml_parser)
+        service_urls = [child[0].text.strip() for child in service_root]
+    except Exception:
+        trace = traceback.format_exc()
+        logger.error("Error while GET {}".format(service_sitemap_url))
+        logger.exception(trace)
+        return []
+
+    # crawl only docs.aws.amazon.com
+    return [url for url in service_urls if "docs.aws.amazon.com" in url]
+
+
+async def get_doc_by_service(service_sitemap_url, session, sem):
     """
     Get documents by service
     """
-    tasks = []
-    sem = asyncio.Semaphore(SEMAPHORE)
-    async with aiohttp.ClientSession() as session:
-        for url in urls:
-            task = burst_fetch(url, session, sem)
-            tasks.append(task)
+    urls = await get_service_urls(service_sitemap_url, session, sem)
+    if len(urls) == 0:
+        logger.info(
+            "No doc in docs.aws.amazon.com. skipping {}".format(service_sitemap_url))
+        return []
+
+    logger.info("Documents in service: {} {}".format(
+        len(urls), service_sitemap_url))
 
-        return await asyncio.wait(tasks)
+    results = await asyncio.gather(
+        *(burst_fetch(url, session, sem) for url in urls),
+        return_exceptions=True
+    )
+    for r in results:
+        if isinstance(r, BaseException):
+            logger.exception("Error while crawling service", exc_info=r)
+    return [r for r in results if isinstance(r, dict)]
 
 
 def upload_rawdata_to_s3(filtered_data):
@@ -123,80 +210,43 @@ def upload_rawdata_to_s3(filtered_data):
     S3://BUCKET/PREFIX/merged/filtered_rawdata_TIMESTAMP.jsonl.gz
     """
     try:
-        filtered_data_bytes = "\n".join([json.dumps(d) for d in filtered_data]).encode(
-            "utf-8"
-        )
         key = "{}/{}/filtered_rawdata_{}.jsonl.gz".format(
             PREFIX, "merged", TIMESTAMP)
-        s3util.upload_file_with_gzip(BUCKET, key, filtered_data_bytes)
+        s3util.upload_jsonl_with_gzip(BUCKET, key, filtered_data)
     except Exception as e:
         logger.exception("Error while s3 upload", exc_info=e)
 
 
-def get_all_docs(sitemap_urls):
+async def get_all_docs(sitemap_urls):
     """
     Get all AWS documents
-    """
-    remain_count = len(sitemap_urls)
-    data_list = []
 
+    All services are crawled on one event loop and one HTTP session, sharing
+    a single semaphore so slow sitemaps overlap with fast ones
+    """
+    service_sitemap_urls = []
     for service_sitemap_url in sitemap_urls:
-        logger.info(
-            "({0}/{1}) {2}".format(remain_count,
-                                   len(sitemap_urls), service_sitemap_url)
-        )
         if not is_ok_url(service_sitemap_url):
-            logger.info("Skipping this sitemap.xml")
-            remain_count -= 1
+            logger.info("Skipping {}".format(service_sitemap_url))
             continue
+        service_sitemap_urls.append(service_sitemap_url)
 
-        service_sitemap = None
-        try:
-            # Some sitemap redirects directory to one document url so stop redirect
-            service_sitemap = s.get(service_sitemap_url, allow_redirects=False)
-        except Exception:
-            trace = traceback.format_exc()
-            logger.error("Error while GET {}".format(service_sitemap_url))
-            logger.exception(trace)
-            continue
-
-        if service_sitemap.status_code != 200:
-            logger.warning(
-                "failed to get this sitemap.xml due to {}({})".format(
-                    service_sitemap.status_code, service_sitemap.reason
-                )
-            )
-            continue
-
-        service_root = ET.fromstring(service_sitemap.text.encode("utf-8"))
-        service_urls = [child[0].text.strip() for child in service_root]
-
-        # crawl only docs.aws.amazon.com
-        filtered_service_urls = list(
-            filter(lambda url: "docs.aws.amazon.com" in url, service_urls)
-        )
-        if len(filtered_service_urls) == 0:
-            logger.info("No doc in docs.aws.amazon.com. skipping...")
-            remain_count -= 1
-            continue
-
-        logger.info("Documents in service: {}".format(
-            len(filtered_service_urls)))
-
-        # Get HTMLs in parallel by asyncio
-        done, _ = asyncio.run(get_doc_by_service(filtered_service_urls))
-        for d in done:
-            data_list.append(d.result())
-
-        remain_count -= 1
+    sem = asyncio.Semaphore(SEMAPHORE)
+    # Leave headroom over SEMAPHORE (en + ja request per slot)
+    connector = aiohttp.TCPConnector(
+        limit=2 * SEMAPHORE, ttl_dns_cache=300, keepalive_timeout=60)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = [
+            get_doc_by_service(url, session, sem) for url in service_sitemap_urls
+        ]
+        data_list = []
+        for i, task in enumerate(asyncio.as_completed(tasks), 1):
+            data_list.extend(await task)
+            logger.info("({0}/{1}) services done".format(i, len(tasks)))
 
-    # Filter crawled data
-    logger.info("Filtering all documets")
-    filtered_data_list = filter_data(data_list)
     logger.info("Document size(All)     : {}".format(len(data_list)))
-    logger.info("Document size(Filtered): {}".format(len(filtered_data_list)))
 
-    return filtered_data_list
+    return data_list
 
 
 @calc_time
@@ -210,19 +260,22 @@ def main():
     logger.info("SEMAPHORE: {}".format(SEMAPHORE))
 
     root_sitemap = s.get(ROOT_SITEMAP_URL)
-    root = ET.fromstring(root_sitemap.text.encode("utf-8"))
+    root = etree.fromstring(root_sitemap.content, xml_parser)
     service_sitemap_urls = [child[0].text.strip() for child in root]
 
     logger.info("Number of sitemap.xml: {}".format(
         len(service_sitemap_urls)))
 
-    # Get and filter all documents
-    filtered_data_list = get_all_docs(service_sitemap_urls)
-
-    # Upload merged jsonl
-    if (len(filtered_data_list) > 0):
-        logger.info("Uploading to S3")
-        upload_rawdata_to_s3(filtered_data_list)
+    # Get all documents, filter them and stream them into merged jsonl.
+    # Crawled records are drained from the list as they are filtered, so no
+    # other reference is kept here and each one is freed once uploaded
+    logger.info("Crawling all documents")
+    filtered_data = filter_data(
+        drain(asyncio.run(get_all_docs(service_sitemap_urls))))
+    first = next(filtered_data, None)
+    if first is not None:
+        logger.info("Filtering and uploading to S3")
+        upload_rawdata_to_s3(itertools.chain([first], filtered_data))
     else:
         logger.info("skip upload to s3")
 
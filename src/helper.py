@@ -1,13 +1,99 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
+from functools import lru_cache
 import logging
+import os
+import re
 import time
 import traceback
+from typing import Optional
 
-import lxml
-from lxml.html.clean import clean_html
+from selectolax.lexbor import LexborHTMLParser
 
 logger = logging.getLogger("crawler").getChild(__name__)
 
+# Max records in flight per parse worker in filter_data, so parsed results
+# do not pile up when the consumer (gzip/S3 upload) is slower than workers
+MAX_PENDING_PER_WORKER = 4
+
+_META_SELECTOR = "meta[name=product], meta[name=guide]"
+# Tags whose text is not part of the document content
+_NON_CONTENT_TAGS = ["script", "style", "noscript", "iframe", "object", "embed"]
+_WS_RE = re.compile(r"\s+")
+_URL_TO_PATH_TABLE = str.maketrans({".": "__", "/": "_"})
+
+# Doc URLs containing any of these are skipped
+NG_LIST = [
+    "aws-sdk-php",
+    "AWSAndroidSDK",
+    "AWSiOSSDK",
+    "AWSJavaScriptSDK",
+    "AWSJavaSDK",
+    "awssdkrubyrecord",
+    "encryption-sdk",
+    "mobile-sdk",
+    "pythonsdk",
+    "powershell",
+    "sdk-for-android",
+    "sdk-for-cpp",
+    "sdk-for-go",
+    "sdk-for-ios",
+    "sdk-for-java",
+    "sdk-for-javascript",
+    "sdk-for-net",
+    "sdk-for-php",
+    "sdk-for-php1",
+    "sdk-for-ruby",
+    "sdk-for-unity",
+    "sdkfornet",
+    "sdkfornet1",
+    "xray-sdk-for-java",
+    "code-samples",
+]
+_NG_RE = re.compile("|".join(re.escape(ng) for ng in NG_LIST))
+
+# Doc URLs excluded from filtered data, with the reason logged for each
+_FILTER_REASONS = {
+    "apireference": "API Reference",
+    "/cli/": "AWS CLI",
+    "/code-samples/": "code samples",
+}
+_FILTER_RE = re.compile(
+    "|".join(re.escape(f) for f in _FILTER_REASONS), re.IGNORECASE)
+
+
+@dataclass
+class Doc:
+    """
+    Filtered and normalized AWS document
+
+    Serialized by orjson with the fields in this order
+    """
+
+    __slots__ = (
+        "crawled_at", "url", "last_modified", "product", "guide", "title",
+        "content", "raw_html", "url_ja", "last_modified_ja", "product_ja",
+        "guide_ja", "title_ja", "content_ja", "raw_html_ja",
+    )
+
+    crawled_at: str
+    url: str
+    last_modified: str
+    product: Optional[str]
+    guide: Optional[str]
+    title: str
+    content: str
+    raw_html: str
+    url_ja: str
+    last_modified_ja: str
+    product_ja: Optional[str]
+    guide_ja: Optional[str]
+    title_ja: str
+    content_ja: str
+    raw_html_ja: str
+
 
 def calc_time(fn):
     """
@@ -28,7 +114,7 @@ def url_to_path(url: str):
     """
     Convert URL to path
     """
-    return url.replace("://", "___").replace(".", "__").replace("/", "_")
+    return url.replace("://", "___").translate(_URL_TO_PATH_TABLE)
 
 
 def path_to_url(path: str):
@@ -46,10 +132,22 @@ def chunks(lst, n):
         yield lst[i: i + n]
 
 
+def drain(lst):
+    """
+    Yield items from lst, removing each one so it can be freed once consumed
+    """
+    lst.reverse()
+    while lst:
+        yield lst.pop()
+
+
+@lru_cache(maxsize=8192)
 def to_isoformat(date_str: str) -> str:
     """
     Last-modified to isoformat
     Sat, 27 Jun 2020 02:00:18 GMT => 2020-06-27T02:00:18
+
+    Many documents share the same Last-Modified, so results are cached
     """
     return datetime.strptime(date_str, "%a, %d %b %Y %H:%M:%S %Z").isoformat()
 
@@ -58,64 +156,33 @@ def is_ok_url(url: str):
     """
     Check doc url is valid
     """
-    ng_list = [
-        "aws-sdk-php",
-        "AWSAndroidSDK",
-        "AWSiOSSDK",
-        "AWSJavaScriptSDK",
-        "AWSJavaSDK",
-        "awssdkrubyrecord",
-        "encryption-sdk",
-        "mobile-sdk",
-        "pythonsdk",
-        "powershell",
-        "sdk-for-android",
-        "sdk-for-cpp",
-        "sdk-for-go",
-        "sdk-for-ios",
-        "sdk-for-java",
-        "sdk-for-javascript",
-        "sdk-for-net",
-        "sdk-for-php",
-        "sdk-for-php1",
-        "sdk-for-ruby",
-        "sdk-for-unity",
-        "sdkfornet",
-        "sdkfornet1",
-        "xray-sdk-for-java",
-        "code-samples",
-    ]
-
-    for ng in ng_list:
-        if ng in url:
-            return False
-
-    return True
+    return _NG_RE.search(url) is None
 
 
 def _parse_html(html: str):
     """
     Parse HTML
     """
-    h = lxml.html.fromstring(html)
-    title = h.cssselect("title")[0].text
+    tree = LexborHTMLParser(html)
+    title = tree.css_first("title").text()
 
     product = None
     guide = None
     try:
-        for meta in h.cssselect("meta"):
-            if meta.get("name") == "product":
-                product = meta.get("content")
-            if meta.get("name") == "guide":
-                guide = meta.get("content")
+        for meta in tree.css(_META_SELECTOR):
+            if meta.attributes.get("name") == "product":
+                product = meta.attributes.get("content")
+            if meta.attributes.get("name") == "guide":
+                guide = meta.attributes.get("content")
     except Exception:
         pass
 
-    # Normalize by clean_html
-    # https://lxml.de/lxmlhtml.html#cleaning-up-html
-    content = clean_html(h).text_content()
-    content = "".join([line.strip()
-                       for line in content.splitlines()])
+    # Drop non-content tags instead of a full lxml clean_html pass.
+    # Text of the whole document (including <title>) is joined without
+    # separators so inline tags do not split Japanese sentences
+    tree.strip_tags(_NON_CONTENT_TAGS)
+    content = tree.root.text(separator="", strip=False)
+    content = _WS_RE.sub(" ", content).strip()
 
     return {
         "title": title,
@@ -125,61 +192,94 @@ def _parse_html(html: str):
     }
 
 
-def filter_data(data_list):
+def _is_target(data):
     """
-    Filter and normalize AWS document data
+    Check record has URLs and is not filtered out by URL
     """
-    doc_list = []
+    if "url" not in data or "url_ja" not in data:
+        logger.warning("cannot retrieve url, skipping...")
+        return False
 
-    for data in data_list:
-        try:
-            url = data["url"]
-            url_ja = data["url_ja"]
-        except Exception:
-            logger.exception(traceback.format_exc())
-            logger.warning("cannot retrieve url, skipping...")
-            continue
-
-        logger.info("  Start {}".format(url))
-
-        # Filter by URL
-        if "apireference" in url.lower():
-            logger.warning("API Reference")
-            continue
-        if "/cli/" in url.lower():
-            logger.warning("AWS CLI")
-            continue
-        if "/code-samples/" in url.lower():
-            logger.warning("code samples")
-            continue
+    url = data["url"]
+    logger.debug("  Start %s", url)
 
-        try:
-            parsed_doc = _parse_html(data["html"])
-            parsed_doc_ja = _parse_html(data["html_ja"])
-
-            doc_list.append(
-                {
-                    "crawled_at": data["crawled_at"],
-                    "url": url,
-                    "last_modified": data["last_modified"],
-                    "product": parsed_doc["product"],
-                    "guide": parsed_doc["guide"],
-                    "title": parsed_doc["title"],
-                    "content": parsed_doc["content"],
-                    "raw_html": data["html"],
-                    "url_ja": url_ja,
-                    "last_modified_ja": data["last_modified_ja"],
-                    "product_ja": parsed_doc_ja["product"],
-                    "guide_ja": parsed_doc_ja["guide"],
-                    "title_ja": parsed_doc_ja["title"],
-                    "content_ja": parsed_doc_ja["content"],
-                    "raw_html_ja": data["html_ja"],
-                }
-            )
+    # Filter by URL
+    m = _FILTER_RE.search(url)
+    if m is not None:
+        logger.warning(_FILTER_REASONS[m.group().lower()])
+        return False
 
+    return True
+
+
+def _parse_htmls(html: str, html_ja: str):
+    """
+    Parse en/ja HTML in worker process
+
+    Only the parsed fields are sent back, raw HTML stays in the parent
+    """
+    return _parse_html(html), _parse_html(html_ja)
+
+
+def _to_doc(data, parsed_doc, parsed_doc_ja):
+    """
+    Build Doc from crawled record and its parsed en/ja HTML
+    """
+    return Doc(
+        crawled_at=data["crawled_at"],
+        url=data["url"],
+        last_modified=data["last_modified"],
+        product=parsed_doc["product"],
+        guide=parsed_doc["guide"],
+        title=parsed_doc["title"],
+        content=parsed_doc["content"],
+        raw_html=data["html"],
+        url_ja=data["url_ja"],
+        last_modified_ja=data["last_modified_ja"],
+        product_ja=parsed_doc_ja["product"],
+        guide_ja=parsed_doc_ja["guide"],
+        title_ja=parsed_doc_ja["title"],
+        content_ja=parsed_doc_ja["content"],
+        raw_html_ja=data["html_ja"],
+    )
+
+
+def filter_data(data_list):
+    """
+    Filter and normalize AWS document data, yielding Doc one by one
+    """
+    max_workers = os.cpu_count() or 1
+    max_pending = max_workers * MAX_PENDING_PER_WORKER
+    pending = deque()
+    count = 0
+
+    def pop_result():
+        data, future = pending.popleft()
+        try:
+            return _to_doc(data, *future.result())
         except Exception:
             logger.exception(traceback.format_exc())
-            logger.warning("  Skipping this URL... {}".format(url))
-            continue
-
-    return doc_list
+            logger.warning("  Skipping this URL... {}".format(data["url"]))
+            return None
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for data in data_list:
+            if not _is_target(data):
+                continue
+
+            pending.append(
+                (data, executor.submit(_parse_htmls, data["html"], data["html_ja"])))
+
+            if len(pending) >= max_pending:
+                doc = pop_result()
+                if doc is not None:
+                    count += 1
+                    yield doc
+
+        while pending:
+            doc = pop_result()
+            if doc is not None:
+                count += 1
+                yield doc
+
+    logger.info("Document size(Filtered): {}".format(count))
@@ -1,15 +1,40 @@
 from io import BytesIO
 import gzip
-import json
 import logging
+import os
+from tempfile import SpooledTemporaryFile
 import traceback
 
 import boto3
+import orjson
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 logger = logging.getLogger("crawler").getChild(__name__)
 
-s3 = boto3.client("s3")
+# One client shared by all helpers, with a pool large enough for
+# concurrent transfers so connections are reused instead of discarded
+MAX_POOL_CONNECTIONS = 64
+s3 = boto3.client(
+    "s3",
+    config=Config(
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        retries={"max_attempts": 10, "mode": "adaptive"},
+    ),
+)
+
+MB = 1024 * 1024
+# Large objects are sent as parallel multipart uploads
+transfer_config = TransferConfig(
+    multipart_threshold=8 * MB, multipart_chunksize=8 * MB, max_concurrency=10
+)
+# Objects, and byte ranges of large objects, are fetched in parallel by one
+# transfer manager whose concurrency matches the client connection pool
+download_transfer_config = TransferConfig(
+    multipart_threshold=8 * MB, multipart_chunksize=8 * MB,
+    max_concurrency=MAX_POOL_CONNECTIONS
+)
 
 
 def upload_file(bucket: str, key: str, data: bytes):
@@ -45,23 +70,60 @@ def upload_file_with_gzip(bucket: str, key: str, data: bytes):
         return False
 
 
+def upload_jsonl_with_gzip(bucket: str, key: str, records):
+    """
+    Upload records (dict or dataclass) as gzipped jsonl
+
+    Records are serialized one by one into a spooled temporary file, so the
+    whole jsonl never has to be held in memory at once
+    """
+    try:
+        with SpooledTemporaryFile(max_size=64 * MB) as tmp:
+            with gzip.GzipFile(fileobj=tmp, mode="wb", compresslevel=6) as gz:
+                for record in records:
+                    gz.write(orjson.dumps(record) + b"\n")
+            tmp.seek(0)
+
+            s3.upload_fileobj(tmp, bucket, key, ExtraArgs={
+                              "ContentEncoding": "gzip"}, Config=transfer_config)
+        return True
+    except ClientError:
+        logger.error("Error while S3 upload s3://{}/{}".format(bucket, key))
+        logger.exception(traceback.format_exc())
+        return False
+
+
+def list_keys(bucket: str, prefix: str):
+    """
+    Yield all object keys under prefix
+    """
+    paginator = s3.get_paginator("list_objects_v2")
+
+    for result in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for file in result.get("Contents", []):
+            yield file.get("Key")
+
+
 def download_dir(bucket="your_bucket", prefix="prefix", local="/tmp"):
     """
     Download as directory
+
+    All objects go through one shared transfer manager, so objects are
+    downloaded in parallel, and large objects in byte ranges, without
+    exceeding the connection pool
     """
     try:
-        paginator = s3.get_paginator("list_objects")
-
-        for result in paginator.paginate(Bucket=bucket, Delimiter="/", Prefix=prefix):
-            if result.get("CommonPrefixes") is not None:
-                for subdir in result.get("CommonPrefixes"):
-                    download_dir(subdir.get("Prefix"), local, bucket)
-
-            for file in result.get("Contents", []):
-                dest_pathname = os.path.join(local, file.get("Key"))
-                if not os.path.exists(os.path.dirname(dest_pathname)):
-                    os.makedirs(os.path.dirname(dest_pathname))
-                s3.download_file(bucket, file.get("Key"), dest_pathname)
+        with create_transfer_manager(s3, download_transfer_config) as manager:
+            futures = []
+            for key in list_keys(bucket, prefix):
+                if key.endswith("/"):
+                    continue
+                dest_pathname = os.path.join(local, key)
+                os.makedirs(os.path.dirname(dest_pathname), exist_ok=True)
+                futures.append(manager.download(bucket, key, dest_pathname))
+
+            for future in futures:
+                future.result()
 
         return True
 